@@ -13,41 +13,57 @@ import argparse
 import collections
 import io
 import math
+import mmap
 import os
+import stat
 import struct
 import sys
 from typing import Optional
 
+_MASK32 = 0xffffffff
+
+_U32 = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+# RISC iX partition descriptor at 0x1fc: flag byte and 16-bit cylinder
+_RISCIX_DESC = struct.Struct('<BH')
+# Defect list area of a boot block, 0x0-0x1bf
+_DEFECT_WORDS = struct.Struct('<112I')
+
 def sum8(data: bytes):
     """
     Calculate an 8 bit byte-wise rolling sum
+
+    The rolling sum subtracts 255 whenever it overflows a byte, which leaves
+    it congruent to the plain total modulo 255, but in the range 1-255 for any
+    nonzero total. Compute it in closed form so that the summation happens
+    entirely within the builtin sum().
     """
-    sum = 0
-    for b in data:
-        sum += int(b)
-        if sum > 255:
-            sum -= 255
-    return sum
+    total = sum(data)
+    return total and 1 + (total - 1) % 255
 
 def ror(n: int, r: int):
     """Equivalent to ARM ROR Rout,Rn,Rr"""
-    width=32
-    return (2**width-1)&(n>>r|n<<(width-r))
+    return _MASK32 & (n >> r | n << (32 - r))
 
 def defect_checksum(defects: list[int]):
     """Calculate FileCore defect list checksum"""
     checksum = 0
     for defect in defects:
-        checksum = ror(checksum, 13)
+        # ROR #13, written out to avoid a function call per defect
+        checksum = ((checksum >> 13) | (checksum << 19)) & _MASK32
         checksum ^= defect
-    
-    checksum ^= checksum >> 16
-    checksum ^= checksum >> 8
-    checksum &= 0xff
-    return checksum
+
+    # XOR-fold all four bytes down to eight bits
+    return (checksum ^ (checksum >> 8) ^ (checksum >> 16) ^
+            (checksum >> 24)) & 0xff
 
 def chunks(lst, n: int):
-    """Yield successive n-sized chunks from lst."""
+    """
+    Yield successive n-sized chunks from lst. Byte strings are chunked as
+    memoryviews so that no data is copied.
+    """
+    if isinstance(lst, (bytes, bytearray)):
+        lst = memoryview(lst)
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
@@ -61,18 +77,15 @@ class HWParams(abc.ABC):
     Abstract base class for hardware-specific parameter blocks.
     """
 
-    # Struct format string
+    # Struct format string. Subclasses get it precompiled as _struct, with
+    # its size in _size.
     format = ''
+    _size = 0
 
-    @classmethod
-    def get_data(cls, data: bytes):
-        """
-        Hardware-specific parameters are stored at the high end of 0x0-0x1bf
-        (i.e. a 16 byte hardware-specific parameter block occpuies addresses
-        0x1b0-0x1bf). Extract the correct amount of data based on our format
-        string.
-        """
-        return data[-struct.calcsize(cls.format):]
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._struct = struct.Struct(cls.format)
+        cls._size = cls._struct.size
 
     @classmethod
     @abc.abstractmethod
@@ -80,9 +93,14 @@ class HWParams(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def serialise(self):
+    def pack_into(self, buf: bytearray, offset: int):
         pass
 
+    def serialise(self):
+        buf = bytearray(self._size)
+        self.pack_into(buf, 0)
+        return bytes(buf)
+
     @abc.abstractmethod
     def __init__(self):
         pass
@@ -99,7 +117,9 @@ class AWHwParams(HWParams):
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        fields = struct.unpack(cls.format, cls.get_data(data))
+        # Hardware-specific parameters are stored at the high end of
+        # 0x0-0x1bf, right up against the disc record.
+        fields = cls._struct.unpack_from(data, len(data) - cls._size)
 
         if fields[0] != cls.magic:
             raise DiscImageException(f'Bad magic number in hardware '
@@ -111,8 +131,8 @@ class AWHwParams(HWParams):
     def __init__(self, params: bytes):
         self.params = params
     
-    def serialise(self):
-        return struct.pack(self.format, self.magic, self.params)
+    def pack_into(self, buf: bytearray, offset: int):
+        self._struct.pack_into(buf, offset, self.magic, self.params)
 
 
 class DiscRecord(collections.namedtuple('DiscRecord', [
@@ -123,11 +143,11 @@ class DiscRecord(collections.namedtuple('DiscRecord', [
     Representation of a FileCore Disc Record. See PRM for details.
     """
 
-    format = '<BBBBBBBBBBHIIH10sI24s'
+    _struct = struct.Struct('<BBBBBBBBBBHIIH10sI24s')
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        fields = list(struct.unpack(cls.format, data))
+        fields = list(cls._struct.unpack(data))
         # Sector size and bytes per map block are stored as the log2 of the
         # actual value. Represent them here as the actual value.
         fields[0] = 2 ** fields[0]
@@ -142,14 +162,21 @@ class DiscRecord(collections.namedtuple('DiscRecord', [
     def name(self, value: str):
         self.name_raw = value.encode('ascii')
 
+    def pack_into(self, buf: bytearray, offset: int):
+        # Sector size and bytes per map block are powers of two, so their log2
+        # is just the position of the top bit.
+        self._struct.pack_into(buf, offset, self.sectorsize.bit_length() - 1,
+                               self.spt, self.heads, self.density, self.idlen,
+                               self.bpmb.bit_length() - 1, self.skew,
+                               self.bootopt, self.lowsector, self.nzones,
+                               self.zonespare, self.root, self.size,
+                               self.cycle, self.name_raw, self.filetype,
+                               self.reserved)
+
     def serialise(self):
-        return struct.pack(self.format, int(math.log2(self.sectorsize)),
-                           self.spt, self.heads, self.density, self.idlen, 
-                           int(math.log2(self.bpmb)), self.skew, self.bootopt,
-                           self.lowsector, self.nzones, self.zonespare,
-                           self.root, self.size, self.cycle,
-                           self.name.encode('ascii'), self.filetype,
-                           self.reserved)
+        buf = bytearray(self._struct.size)
+        self.pack_into(buf, 0)
+        return bytes(buf)
 
 
 class BootBlock:
@@ -159,88 +186,105 @@ class BootBlock:
 
     @classmethod
     def from_bytes(cls, data: bytes, hwparam_class: type[HWParams]):
+        # sum() iterates bytes much faster than a memoryview, so the checksum
+        # works on a copy.
         if sum8(data[:-1]) != data[0x1ff]:
             raise DiscImageException('Bad boot block checksum')
-        defects = []
-        hwparams_start = 0
-        for (word,) in struct.iter_unpack('<I', data):
-            hwparams_start += 4
-            if word & 0xffffff00 == 0x20000000:
-                if word & 0xff == defect_checksum(defects):
-                    break
-                else:
-                    raise DiscImageException('Bad defect list checksum')
-            else:
-                defects.append(word)
 
-        # If the defect list has consumed past the start of the disc record,
-        # then it was clearly not valid and we shouldn't go further.
-        if hwparams_start > 0x1c0:
+        # Slice the rest through a memoryview to avoid copying each field
+        view = memoryview(data)
+
+        # The defect list is terminated by a word of the form 0x200000xx. If
+        # there is no terminator before the start of the disc record, then it
+        # was clearly not valid and we shouldn't go further.
+        words = _DEFECT_WORDS.unpack_from(view)
+        end = next((i for i, word in enumerate(words)
+                    if word & 0xffffff00 == 0x20000000), None)
+        if end is None:
             raise DiscImageException('Invalid defect list')
 
-        hwparams = hwparam_class.from_bytes(data[hwparams_start:0x1c0])
+        defects = list(words[:end])
+        if words[end] & 0xff != defect_checksum(defects):
+            raise DiscImageException('Bad defect list checksum')
+        hwparams_start = 4 * (end + 1)
+
+        hwparams = hwparam_class.from_bytes(view[hwparams_start:0x1c0])
 
         # Technically we should only use the boot block Disc Record in order to
         # find the map, and then use the map Disc Record as our actual source of
         # truth about the volume. However in practice, the boot block copy seems
         # to be good enough.
-        discrec = DiscRecord.from_bytes(data[0x1c0:0x1fc])
+        discrec = DiscRecord.from_bytes(view[0x1c0:0x1fc])
 
         # Technically 1fc-1fe is the "non-ADFS partition descriptor" but AFAIK
         # it was only ever used for RISC iX. Note that the cylinder number here
         # is in 256-byte sectors.
         riscix_flag = data[0x1fc]
         if riscix_flag:
-            riscix_cylinder = struct.unpack('<H', data[0x1fd:0x1ff])[0]
+            riscix_cylinder = _U16.unpack_from(view, 0x1fd)[0]
         else:
             riscix_cylinder = None
 
         return cls(defects, hwparams, discrec, riscix_cylinder)
 
-    def __init__(self, defects: list[int]=[], hwparams: HWParams=None, 
-                 disc_record: DiscRecord=None, 
+    def __init__(self, defects: Optional[list[int]]=None,
+                 hwparams: HWParams=None, disc_record: DiscRecord=None,
                  riscix_cylinder: Optional[int]=None):
-        self.defects = defects
+        self.defects = list(defects) if defects is not None else []
         self.hwparams = hwparams
         self.disc_record = disc_record
         self.riscix_cylinder = riscix_cylinder
 
     def serialise(self):
-        defects_end = 0x20000000 | defect_checksum(self.defects)
-        defectlist = struct.pack('<I' + 'I' * len(self.defects),
-                                 *(self.defects + [defects_end]))
-
-        hwparams = self.hwparams.serialise()
-
-        # left-pad hardware params to fill unused defect list space
-        hwparams = bytes(0x1c0 - len(defectlist) - len(hwparams)) + hwparams
-
-        disc_record = self.disc_record.serialise()
+        # Everything is packed into a single zero-filled buffer, so any
+        # defect list space not used by the defects or the hardware params
+        # is left as zero padding.
+        bootblock = bytearray(512)
+
+        # Hardware params sit right-aligned against the disc record
+        hwparams_start = 0x1c0 - self.hwparams._size
+        if 4 * (len(self.defects) + 1) > hwparams_start:
+            raise DiscImageException('Defect list too long')
+
+        offset = 0
+        for defect in self.defects:
+            _U32.pack_into(bootblock, offset, defect)
+            offset += 4
+        _U32.pack_into(bootblock, offset,
+                       0x20000000 | defect_checksum(self.defects))
+
+        self.hwparams.pack_into(bootblock, hwparams_start)
+
+        self.disc_record.pack_into(bootblock, 0x1c0)
         if self.riscix_cylinder is not None:
-            riscix_descriptor = struct.pack('<BH', 1, self.riscix_cylinder)
-        else:
-            riscix_descriptor = bytes([0, 0, 0])
+            _RISCIX_DESC.pack_into(bootblock, 0x1fc, 1, self.riscix_cylinder)
 
-        bootblock = defectlist + hwparams + disc_record + riscix_descriptor
-
-        checksum = struct.pack('B', sum8(bootblock))
-        return bootblock + checksum
+        bootblock[0x1ff] = sum8(bootblock[:0x1ff])
+        return bytes(bootblock)
 
 
 class RiscixPartition:
     """
     Representation of a RISC iX partition table entry
     """
-    format = '<3I16s'
+    _struct = struct.Struct('<3I16s')
 
     @classmethod
-    def from_bytes(cls, data: bytes):
-        fields = struct.unpack(cls.format, data)
-        if fields[0] == 0 or fields[1] == 0:
+    def from_fields(cls, start_cylinder: int, num_cylinders: int, flags: int,
+                    name: bytes):
+        """
+        Construct a partition from unpacked table entry fields, or return None
+        if the entry is empty.
+        """
+        if start_cylinder == 0 or num_cylinders == 0:
             return None
         else:
-            return cls(fields[3].strip(b'\0').decode('ascii'), fields[0],
-                       fields[1])
+            return cls(name.rstrip(b'\0').decode('ascii'), start_cylinder,
+                       num_cylinders)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        return cls.from_fields(*cls._struct.unpack(data))
 
     def __init__(self, name: str, start_cylinder: int, num_cylinders: int):
         self.name = name
@@ -250,9 +294,14 @@ class RiscixPartition:
     def __repr__(self):
         return f'RiscixPartition({self.name, self.start_cylinder, self.num_cylinders})'
 
+    def pack_into(self, buf: bytearray, offset: int):
+        self._struct.pack_into(buf, offset, self.start_cylinder,
+                               self.num_cylinders, 1, self.name.encode('ascii'))
+
     def serialise(self):
-        return struct.pack(self.format, self.start_cylinder,
-                           self.num_cylinders, 1, self.name.encode('ascii'))
+        buf = bytearray(self._struct.size)
+        self.pack_into(buf, 0)
+        return bytes(buf)
 
 
 class RiscixPartitionTable(collections.UserList):
@@ -266,15 +315,16 @@ class RiscixPartitionTable(collections.UserList):
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        magic = struct.unpack('<I', data[0:4])[0]
+        magic = _U32.unpack_from(data)[0]
         if magic != cls.ptable_magic:
             raise DiscImageException('Invalid magic number in RISC iX '
                                      'partition table')
 
         partitions = []
         # Each partition table entry is 28 bytes, we support up to 16 entries
-        for (chunk,) in struct.iter_unpack(f'28s', data[4:452]):
-            part = RiscixPartition.from_bytes(chunk)
+        for fields in RiscixPartition._struct.iter_unpack(
+                memoryview(data)[4:452]):
+            part = RiscixPartition.from_fields(*fields)
             if part is None:
                 break
             else:
@@ -282,21 +332,26 @@ class RiscixPartitionTable(collections.UserList):
 
         return RiscixPartitionTable(partitions)
 
-    def __init__(self, partitions: list[RiscixPartition]=[]):
-        self.data = partitions
+    def __init__(self, partitions: Optional[list[RiscixPartition]]=None):
+        self.data = list(partitions) if partitions is not None else []
 
     def __repr__(self):
         return f'RiscixPartitionTable({self.data})'
 
     def serialise(self):
-        ptable = struct.pack('<I' + len(self.data) * '28s', self.ptable_magic,
-                             *[partition.serialise() for partition in self.data])
-        ptable += b'\x00' * (512 - len(ptable))
+        if len(self.data) > 16:
+            raise DiscImageException('Too many RISC iX partitions (maximum 16)')
+
+        # Partition table in the first 512 bytes, bad-block table in the
+        # second, both zero-padded.
+        buf = bytearray(1024)
+        _U32.pack_into(buf, 0, self.ptable_magic)
+        for i, partition in enumerate(self.data):
+            partition.pack_into(buf, 4 + i * RiscixPartition._struct.size)
 
         # Write out an empty bad-block table. IDE driver ignores it anyway.
-        bbtable = struct.pack('<I', self.bbtable_magic)
-        bbtable += b'\x00' * (512 - len(bbtable))
-        return ptable + bbtable
+        _U32.pack_into(buf, 512, self.bbtable_magic)
+        return bytes(buf)
 
 
 AWPartition = collections.namedtuple('AWPartition',
@@ -307,41 +362,62 @@ def find_partitions(image: io.BufferedReader):
     """
     Find all RISC OS partitions in an image
     """
-    offset = 0
     partitions = []
-    while True:
-        image.seek(offset + 0xc00, os.SEEK_SET)
-        data = image.read(512)
-
-        # Reached EOF, no more partitions
-        if len(data) != 512:
-            break
-
-        # Parse the boot block.
-        try:
-            bootblock = BootBlock.from_bytes(data, AWHwParams)
-        except DiscImageException as e:
-            print(f'find_partitions: rejected potential RISC OS partition at '
-                  f'{offset:x}: {e}')
-            break
-
-        # Validate partition extent
-        if image.seek(offset + bootblock.disc_record.size, os.SEEK_SET) != \
-                offset + bootblock.disc_record.size:
-            break
-
-        cyl_size = (bootblock.disc_record.sectorsize * 
-                    bootblock.disc_record.spt * bootblock.disc_record.heads)
-
-        if bootblock.riscix_cylinder:
-            image.seek(offset + bootblock.riscix_cylinder // 2 * cyl_size,
-                       os.SEEK_SET)
-            riscix_pt = RiscixPartitionTable.from_bytes(image.read(1024))
-        else:
-            riscix_pt = None
 
-        partitions.append(AWPartition(offset, bootblock, riscix_pt))
-        offset += bootblock.disc_record.size
+    # Map regular files once rather than seeking and reading for every boot
+    # block and partition table. mmap can't size anything else (e.g. a raw
+    # block device) and refuses empty files, so fall back to seek and read.
+    # The same goes for streams with no file descriptor at all.
+    try:
+        st = os.fstat(image.fileno())
+        mappable = stat.S_ISREG(st.st_mode) and st.st_size > 0
+    except (io.UnsupportedOperation, OSError):
+        mappable = False
+
+    if mappable:
+        mm = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def read(offset: int, length: int):
+            return mm[offset:offset + length]
+    else:
+        mm = None
+
+        def read(offset: int, length: int):
+            image.seek(offset, os.SEEK_SET)
+            return image.read(length)
+
+    try:
+        offset = 0
+        while True:
+            data = read(offset + 0xc00, 512)
+
+            # Reached EOF, no more partitions
+            if len(data) != 512:
+                break
+
+            # Parse the boot block.
+            try:
+                bootblock = BootBlock.from_bytes(data, AWHwParams)
+            except DiscImageException as e:
+                print(f'find_partitions: rejected potential RISC OS partition '
+                      f'at {offset:x}: {e}')
+                break
+
+            cyl_size = (bootblock.disc_record.sectorsize * 
+                        bootblock.disc_record.spt * bootblock.disc_record.heads)
+
+            if bootblock.riscix_cylinder:
+                riscix_pt = RiscixPartitionTable.from_bytes(
+                    read(offset + bootblock.riscix_cylinder // 2 * cyl_size,
+                         1024))
+            else:
+                riscix_pt = None
+
+            partitions.append(AWPartition(offset, bootblock, riscix_pt))
+            offset += bootblock.disc_record.size
+    finally:
+        if mm is not None:
+            mm.close()
 
     return partitions
 